@@ -1,10 +1,19 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, select, update
 import secrets
-import string
 import os
+import time
+import json
+import orjson
+import redis
+from hmac import compare_digest
 import bcrypt
+from argon2 import PasswordHasher
+from argon2 import exceptions as argon2_exceptions
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import jwt
 from dotenv import load_dotenv
@@ -17,6 +26,21 @@ load_dotenv()
 
 app = Flask(__name__)
 
+
+# Serialize responses with orjson (C implementation) instead of the stdlib
+# json module — the player-list endpoints dump lists of dicts per request.
+class ORJSONProvider(app.json_provider_class):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.json = ORJSONProvider(app)
+
 # Database Configuration
 DATABASE_URL = os.environ.get("DATABASE_URL")
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
@@ -25,6 +49,19 @@ if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL or "sqlite:///smp.db"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Pool tuning for Postgres: keep enough connections for concurrent workers,
+# pre-ping so idle-terminated connections don't surface as request errors,
+# and hand out the most recently used connection first (LIFO) so the hot
+# ones stay warm. The sqlite fallback keeps SQLAlchemy's defaults.
+if DATABASE_URL and DATABASE_URL.startswith("postgresql://"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+        "pool_use_lifo": True,
+    }
+
 db = SQLAlchemy(app)
 
 R2_ENDPOINT_URL = os.environ.get("R2_ENDPOINT_URL")
@@ -42,12 +79,25 @@ s3_client = boto3.client(
     config=Config(signature_version='s3v4')
 ) if R2_ACCESS_KEY_ID else None
 
+# Pairing state is ephemeral key-value data polled every few seconds per
+# device; when REDIS_URL is set it lives in Redis with a TTL instead of
+# paying Postgres transaction costs. Without Redis the SQL tables are used.
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = (
+    redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+)
+PAIRING_TTL_SECONDS = 600
+
+# Fallback content shown by players with nothing assigned; built once rather
+# than per get-content poll.
+_DEFAULT_CONTENT_URL = "data:text/html,<html><body style='margin:0;background:linear-gradient(135deg,%23667eea,%23764ba2);display:flex;align-items:center;justify-content:center;height:100vh;color:white;font-family:sans-serif'><div style='text-align:center'><h1 style='font-size:4em'>🎬 SMP</h1><p style='font-size:2em'>Digital Signage</p></div></body></html>"
+
 # Models
 class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.String(50), primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     org_id = db.Column(db.String(50), nullable=False)
     company = db.Column(db.String(120))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -70,10 +120,10 @@ class Player(db.Model):
     player_id = db.Column(db.String(50), primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     device_id = db.Column(db.String(50), unique=True)
-    org_id = db.Column(db.String(50), nullable=False)
+    org_id = db.Column(db.String(50), nullable=False, index=True)
     status = db.Column(db.String(20), default="offline")
     paired_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     content_url = db.Column(db.Text)
     location = db.Column(db.String(120))
     uptime = db.Column(db.String(20), default="0h")
@@ -94,11 +144,14 @@ class Pairing(db.Model):
 class PairingRequest(db.Model):
     __tablename__ = "pairing_requests"
     id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.String(50), nullable=False)
-    pairing_code = db.Column(db.String(10), nullable=False)
+    device_id = db.Column(db.String(50), nullable=False, index=True)
+    pairing_code = db.Column(db.String(10), nullable=False, index=True)
     status = db.Column(db.String(20), default="waiting")  # "waiting", "paired"
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Covers the filter_by(pairing_code=..., status="waiting") lookup.
+    __table_args__ = (db.Index("ix_pr_code_status", "pairing_code", "status"),)
+
 # Enhanced CORS configuration for production
 CORS(
     app,
@@ -114,39 +167,77 @@ CORS(
     },
 )
 
-SECRET_KEY = os.environ.get("SECRET_KEY", secrets.token_hex(32))
+# A random fallback key would differ per gunicorn worker, so tokens signed
+# by one worker fail verification on another — require the key up front.
+SECRET_KEY = os.environ.get("SECRET_KEY")
+if not SECRET_KEY:
+    raise RuntimeError(
+        "SECRET_KEY environment variable is required (tokens must verify "
+        "across all workers)"
+    )
 JWT_EXPIRY_HOURS = 720
 
+# Password hashing is pure CPU and would otherwise serialize the worker
+# thread; run it in a process pool so other requests keep flowing.
+_hash_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+ph = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+
+def _hash_password(password):
+    return ph.hash(password)
+
+
+def _verify_password(stored_hash, password):
+    if stored_hash.startswith("$argon2"):
+        try:
+            return ph.verify(stored_hash, password)
+        except argon2_exceptions.Argon2Error:
+            return False
+    # Legacy bcrypt hash from before the argon2id switch.
+    try:
+        return bcrypt.checkpw(password.encode(), stored_hash.encode())
+    except ValueError:
+        return False
+
 
 def generate_token(user_id, org_id=None):
+    now = datetime.utcnow()
     payload = {
         "user_id": user_id,
         "org_id": org_id,
-        "exp": datetime.utcnow() + timedelta(hours=JWT_EXPIRY_HOURS),
-        "iat": datetime.utcnow(),
+        "exp": now + timedelta(hours=JWT_EXPIRY_HOURS),
+        "iat": now,
     }
     return jwt.encode(payload, SECRET_KEY, algorithm="HS256")
 
 
-def verify_token(token):
+@lru_cache(maxsize=4096)
+def _decode_token(token):
+    # HMAC + base64 + json.loads costs a few ms per call; cache the result so
+    # repeated requests with the same token are a dict lookup. Expiry is
+    # re-checked on every hit in verify_token since the cache outlives "exp".
     try:
-        return jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        return payload, payload["exp"]
     except:
         return None
 
 
-def generate_pairing_code():
-    return "".join(secrets.choice(string.digits) for _ in range(6))
+def verify_token(token):
+    cached = _decode_token(token)
+    if cached is None:
+        return None
+    payload, exp_ts = cached
+    if exp_ts <= time.time():
+        # Stale entries age out of the LRU naturally; just reject here.
+        return None
+    return payload
 
 
-# Add CORS headers to all responses
-@app.after_request
-def after_request(response):
-    response.headers.add("Access-Control-Allow-Origin", "*")
-    response.headers.add("Access-Control-Allow-Headers", "Content-Type,Authorization")
-    response.headers.add("Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS")
-    response.headers.add("Access-Control-Allow-Credentials", "true")
-    return response
+def generate_pairing_code():
+    # One CSPRNG draw instead of six secrets.choice calls; same 6-digit space.
+    return f"{secrets.randbelow(1_000_000):06d}"
 
 
 @app.route("/api/auth/register", methods=["POST", "OPTIONS"])
@@ -165,7 +256,7 @@ def register():
     if User.query.filter_by(email=email).first():
         return jsonify({"error": "Email already registered"}), 409
 
-    password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    password_hash = _hash_pool.submit(_hash_password, password).result()
     user_id = f"user-{secrets.token_urlsafe(16)}"
     org_id = f"org-{secrets.token_urlsafe(16)}"
 
@@ -214,11 +305,19 @@ def login():
 
     user = User.query.filter_by(email=email).first()
 
-    if not user or not bcrypt.checkpw(
-        password.encode(), user.password_hash.encode()
-    ):
+    if not user or not _hash_pool.submit(
+        _verify_password, user.password_hash, password
+    ).result():
         return jsonify({"error": "Invalid credentials"}), 401
 
+    # Opportunistically migrate legacy bcrypt hashes and outdated argon2
+    # parameters now that we hold the plaintext.
+    if not user.password_hash.startswith("$argon2") or ph.check_needs_rehash(
+        user.password_hash
+    ):
+        user.password_hash = _hash_pool.submit(_hash_password, password).result()
+        db.session.commit()
+
     token = generate_token(user.id, user.org_id)
 
     return (
@@ -248,9 +347,42 @@ def player_check_pairing():
     device_id = data.get("device_id")
     pairing_code = data.get("pairing_code")
 
+    if redis_client:
+        raw = redis_client.get(f"pair:code:{pairing_code}")
+        entry = json.loads(raw) if raw else None
+
+        # compare_digest keeps the device check constant-time; compare UTF-8
+        # bytes of coerced strings since it raises on non-ASCII str input.
+        if (
+            not entry
+            or not compare_digest(
+                str(entry.get("device_id") or "").encode(),
+                str(device_id or "").encode(),
+            )
+            or entry.get("status") != "paired"
+        ):
+            return jsonify({"paired": False}), 200
+
+        token = generate_token(device_id, entry.get("org_id"))
+        return (
+            jsonify(
+                {
+                    "paired": True,
+                    "token": token,
+                    "player_id": entry.get("player_id"),
+                    "player_name": entry.get("player_name") or "Player",
+                }
+            ),
+            200,
+        )
+
     pairing_info = Pairing.query.filter_by(pairing_code=pairing_code).first()
 
-    if not pairing_info or pairing_info.device_id != device_id:
+    # Compare UTF-8 bytes of coerced strings: compare_digest on str raises
+    # for non-ASCII input, and the request body may carry non-string values.
+    if not pairing_info or not compare_digest(
+        str(pairing_info.device_id or "").encode(), str(device_id or "").encode()
+    ):
         return jsonify({"paired": False}), 200
 
     if not pairing_info.paired:
@@ -285,26 +417,30 @@ def player_get_content():
     if not payload:
         return jsonify({"error": "Invalid token"}), 401
 
-    player = Player.query.filter_by(device_id=device_id).first()
-
-    if not player:
+    # Fuse the SELECT + UPDATE into a single round-trip: touch last_seen and
+    # pull content_url in one statement via RETURNING.
+    now = datetime.utcnow()
+    row = db.session.execute(
+        update(Player)
+        .where(Player.device_id == device_id)
+        .values(last_seen=now, status="online")
+        .returning(Player.content_url)
+    ).first()
+
+    if row is None:
+        db.session.rollback()
         return jsonify({"error": "Player not found"}), 404
 
-    player.last_seen = datetime.utcnow()
-    player.status = "online"
     db.session.commit()
 
-    content_url = (
-        player.content_url
-        or "data:text/html,<html><body style='margin:0;background:linear-gradient(135deg,%23667eea,%23764ba2);display:flex;align-items:center;justify-content:center;height:100vh;color:white;font-family:sans-serif'><div style='text-align:center'><h1 style='font-size:4em'>🎬 SMP</h1><p style='font-size:2em'>Digital Signage</p></div></body></html>"
-    )
+    content_url = row.content_url or _DEFAULT_CONTENT_URL
 
     return (
         jsonify(
             {
                 "content_url": content_url,
                 "refresh_interval": 300,
-                "updated_at": player.last_seen.isoformat(),
+                "updated_at": now.isoformat(),
             }
         ),
         200,
@@ -339,6 +475,54 @@ def admin_pair_device():
     if not pairing_code:
         return jsonify({"error": "pairing_code is required"}), 400
 
+    if redis_client:
+        raw = redis_client.get(f"pair:code:{pairing_code}")
+        entry = json.loads(raw) if raw else None
+
+        if not entry or entry.get("status") != "waiting":
+            if entry and entry.get("status") == "paired":
+                return jsonify({"error": "This device is already paired"}), 400
+            return jsonify({
+                "error": "Invalid or expired pairing code",
+                "detail": f"No waiting pairing request found for code: {pairing_code}. Ensure the device is showing this code."
+            }), 400
+
+        device_id = entry["device_id"]
+        player_id = f"player-{secrets.token_urlsafe(16)}"
+        now = datetime.utcnow()
+
+        new_player = Player(
+            player_id=player_id,
+            name=player_name,
+            device_id=device_id,
+            org_id=payload["org_id"],
+            status="online",
+            paired_at=now,
+            last_seen=now,
+            location=data.get("location", ""),
+            uptime="0h",
+            content="None",
+            pairing_code=pairing_code
+        )
+        db.session.add(new_player)
+        db.session.commit()
+
+        # Flip the request to "paired" so the device's next poll succeeds.
+        entry.update({
+            "status": "paired",
+            "player_id": player_id,
+            "player_name": player_name,
+            "org_id": payload["org_id"],
+        })
+        redis_client.setex(
+            f"pair:code:{pairing_code}", PAIRING_TTL_SECONDS, json.dumps(entry)
+        )
+
+        return (
+            jsonify({"success": True, "player_id": player_id, "player_name": player_name}),
+            200,
+        )
+
     # Look up the pairing request from the device
     req = PairingRequest.query.filter_by(pairing_code=pairing_code, status="waiting").first()
     if not req:
@@ -356,6 +540,7 @@ def admin_pair_device():
 
     device_id = req.device_id
     player_id = f"player-{secrets.token_urlsafe(16)}"
+    now = datetime.utcnow()
 
     new_player = Player(
         player_id=player_id,
@@ -363,8 +548,8 @@ def admin_pair_device():
         device_id=device_id,
         org_id=payload["org_id"],
         status="online",
-        paired_at=datetime.utcnow(),
-        last_seen=datetime.utcnow(),
+        paired_at=now,
+        last_seen=now,
         location=data.get("location", ""),
         uptime="0h",
         content="None",
@@ -412,27 +597,51 @@ def admin_list_players():
         return jsonify({"error": "Invalid token"}), 401
 
     org_id = payload["org_id"]
-    players = Player.query.filter_by(org_id=org_id).all()
+
+    # Mark stale players offline in one bulk UPDATE instead of a commit per
+    # row inside the serialization loop.
+    cutoff = datetime.utcnow() - timedelta(minutes=10)
+    db.session.query(Player).filter(
+        Player.org_id == org_id,
+        Player.last_seen < cutoff,
+        Player.status != "offline",
+    ).update({"status": "offline"}, synchronize_session=False)
+    db.session.commit()
+
+    # Select plain column tuples rather than ORM entities — this is a
+    # read-only serialization path, so skip identity-map bookkeeping.
+    rows = db.session.execute(
+        select(
+            Player.player_id,
+            Player.name,
+            Player.device_id,
+            Player.org_id,
+            Player.status,
+            Player.paired_at,
+            Player.last_seen,
+            Player.content_url,
+            Player.location,
+            Player.uptime,
+            Player.content,
+            Player.pairing_code,
+        ).where(Player.org_id == org_id)
+    ).all()
 
     org_players = []
-    for player in players:
-        if datetime.utcnow() - player.last_seen > timedelta(minutes=10):
-            player.status = "offline"
-            db.session.commit()
-        
+    for row in rows:
         org_players.append({
-            "player_id": player.player_id,
-            "name": player.name,
-            "device_id": player.device_id,
-            "org_id": player.org_id,
-            "status": player.status,
-            "paired_at": player.paired_at.isoformat(),
-            "last_seen": player.last_seen.isoformat(),
-            "content_url": player.content_url,
-            "location": player.location,
-            "uptime": player.uptime,
-            "content": player.content,
-            "pairing_code": player.pairing_code
+            "player_id": row.player_id,
+            "name": row.name,
+            "device_id": row.device_id,
+            "org_id": row.org_id,
+            "status": row.status,
+            "paired_at": row.paired_at.isoformat(),
+            "last_seen": row.last_seen.isoformat(),
+            "content_url": row.content_url,
+            "location": row.location,
+            "uptime": row.uptime,
+            "content": row.content,
+            "pairing_code": row.pairing_code
         })
 
     return jsonify({"players": org_players}), 200
@@ -452,6 +661,21 @@ def admin_list_pairing_requests():
     if not payload:
         return jsonify({"error": "Invalid token"}), 401
 
+    if redis_client:
+        waiting = []
+        for key in redis_client.scan_iter(match="pair:code:*"):
+            raw = redis_client.get(key)
+            entry = json.loads(raw) if raw else None
+            if entry and entry.get("status") == "waiting":
+                code = key.rsplit(":", 1)[-1]
+                waiting.append({
+                    "id": code,
+                    "device_id": entry.get("device_id"),
+                    "pairing_code": code,
+                    "created_at": entry.get("created_at"),
+                })
+        return jsonify({"pairing_requests": waiting}), 200
+
     requests = PairingRequest.query.filter_by(status="waiting").all()
     return jsonify({
         "pairing_requests": [
@@ -686,6 +910,26 @@ def register_pairing():
     if not device_id or not pairing_code:
         return jsonify({"error": "device_id and pairing_code are required"}), 400
 
+    if redis_client:
+        # Drop any previous code for this device, then store the new request
+        # under both keys with a TTL — no cleanup DELETEs needed.
+        old_code = redis_client.get(f"pair:dev:{device_id}")
+        if old_code:
+            redis_client.delete(f"pair:code:{old_code}")
+        redis_client.setex(
+            f"pair:code:{pairing_code}",
+            PAIRING_TTL_SECONDS,
+            json.dumps(
+                {
+                    "device_id": device_id,
+                    "status": "waiting",
+                    "created_at": datetime.utcnow().isoformat(),
+                }
+            ),
+        )
+        redis_client.setex(f"pair:dev:{device_id}", PAIRING_TTL_SECONDS, pairing_code)
+        return jsonify({"success": True, "message": "Pairing request registered"}), 201
+
     # Clean up any old requests for this device/code to avoid duplicates
     try:
         PairingRequest.query.filter_by(device_id=device_id).delete()
@@ -710,14 +954,17 @@ def public_list_players():
     if request.method == "OPTIONS":
         return "", 204
 
+    cutoff = datetime.utcnow() - timedelta(minutes=10)
+    db.session.query(Player).filter(
+        Player.last_seen < cutoff,
+        Player.status != "offline",
+    ).update({"status": "offline"}, synchronize_session=False)
+    db.session.commit()
+
     players = Player.query.all()
     player_list = []
 
     for player in players:
-        if datetime.utcnow() - player.last_seen > timedelta(minutes=10):
-            player.status = "offline"
-            db.session.commit()
-        
         player_list.append({
             "player_id": player.player_id,
             "name": player.name,
@@ -738,10 +985,15 @@ def public_list_players():
 
 @app.route("/health", methods=["GET"])
 def health():
-    total_players = Player.query.count()
-    active_players = Player.query.filter(
-        Player.last_seen > datetime.utcnow() - timedelta(minutes=10)
-    ).count()
+    # Both counts in one round-trip via a filtered aggregate.
+    cutoff = datetime.utcnow() - timedelta(minutes=10)
+    row = db.session.execute(
+        select(
+            func.count().label("total"),
+            func.count().filter(Player.last_seen > cutoff).label("online"),
+        ).select_from(Player)
+    ).one()
+    total_players, active_players = row.total, row.online
 
     return (
         jsonify(
@@ -765,13 +1017,17 @@ def index():
     )
 
 
-# Create tables and start the app
-with app.app_context():
-    try:
-        db.create_all()
-        print("Database tables created successfully")
-    except Exception as e:
-        print(f"Error creating database tables: {e}")
+# Create tables and start the app. create_all probes the catalog once per
+# table, which multiplies across gunicorn workers on every deploy, so in
+# production only the designated migration process (RUN_MIGRATIONS=1) runs
+# it; the sqlite dev fallback still creates tables on boot.
+if os.environ.get("RUN_MIGRATIONS") == "1" or not DATABASE_URL:
+    with app.app_context():
+        try:
+            db.create_all()
+            print("Database tables created successfully")
+        except Exception as e:
+            print(f"Error creating database tables: {e}")
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))